@@ -0,0 +1,10 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Branches sharing the catalog; new books have their stock split evenly across them
+INVENTORY_BRANCHES = [
+    branch.strip() for branch in os.getenv("INVENTORY_BRANCHES", "main").split(",") if branch.strip()
+] or ["main"]
@@ -0,0 +1,12 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "memory" keeps buckets per worker; "sqlite" shares them between workers through a table
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_DATABASE_URL = os.getenv("RATE_LIMIT_DATABASE_URL", "sqlite:///./rate_limit.db")
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+# Buckets untouched for this many seconds are evicted
+RATE_LIMIT_IDLE_SECONDS = int(os.getenv("RATE_LIMIT_IDLE_SECONDS", "3600"))
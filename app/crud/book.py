@@ -1,8 +1,11 @@
+from sqlalchemy import func, update
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
 
-from app.models.book import Book, BookAssignment, Category, Tag
-from app.schemas.book import BookCreate, BookUpdate, BookAssignmentCreate
+from app.config.inventory import INVENTORY_BRANCHES
+from app.models.book import Book, BookAssignment, BookInventory, Category, Tag
+from app.schemas.book import BookCreate, BookUpdate, BookAssignmentCreate, BookAssignmentBatchCreate
+from app.utils.events import availability_broker
 
 def create_book(db: Session, book: BookCreate):
     db_category = db.query(Category).filter(Category.id == book.category_id).first()
@@ -14,10 +17,15 @@ def create_book(db: Session, book: BookCreate):
         isbn = book.isbn,
         assignment_type = book.assignment_type,
         total_count = book.total_count,
-        available_count = book.total_count,
         category=db_category,
         tags=db_tags,
     )
+    # Split the stock across branches so checkouts of one title don't share a row
+    share, extra = divmod(book.total_count, len(INVENTORY_BRANCHES))
+    db_book.inventory = [
+        BookInventory(branch=branch, available_count=share + (1 if index < extra else 0))
+        for index, branch in enumerate(INVENTORY_BRANCHES)
+    ]
     db.add(db_book)
     db.commit()
     db.refresh(db_book)
@@ -37,11 +45,80 @@ def update_book(db: Session, book_id: int, book: BookUpdate):
         setattr(db_book, filed, value)
     db.commit()
     db.refresh(db_book)
+    availability_broker.publish_book(db_book)
     return db_book
 
+def _pick_inventory(db: Session, book_id: int, quantity: int, branch: str | None = None):
+    """ Id of a random inventory row with enough stock, so checkouts spread across rows """
+    query = db.query(BookInventory.id).filter(
+        BookInventory.book_id == book_id,
+        BookInventory.available_count >= quantity,
+    )
+    if branch:
+        query = query.filter(BookInventory.branch == branch)
+    return query.order_by(func.random()).limit(1).scalar()
+
+class BranchLimitExceeded(ValueError):
+    """ Enough copies exist in total, but no single branch holds as many as one checkout asks for """
+
+    def __init__(self, book_id: int, largest: int):
+        super().__init__(f"At most {largest} copies of book {book_id} can be checked out at once, the most any single branch holds")
+
+def _check_branch_limit(db: Session, book_id: int, quantity: int, branch: str | None = None):
+    """ Raise BranchLimitExceeded when a checkout only fails because stock is split across branches """
+    query = db.query(
+        func.coalesce(func.sum(BookInventory.available_count), 0),
+        func.coalesce(func.max(BookInventory.available_count), 0),
+    ).filter(BookInventory.book_id == book_id)
+    if branch:
+        query = query.filter(BookInventory.branch == branch)
+    total, largest = query.one()
+    if total >= quantity:
+        raise BranchLimitExceeded(book_id, largest)
+
+def _take_inventory(db: Session, inventory_id: int, quantity: int):
+    """ Atomically decrement one inventory row; False if it no longer has enough stock """
+    inventory = BookInventory.__table__
+    result = db.execute(
+        update(inventory)
+        .where(inventory.c.id == inventory_id, inventory.c.available_count >= quantity)
+        .values(available_count=inventory.c.available_count - quantity)
+    )
+    return result.rowcount == 1
+
+def _put_inventory(db: Session, inventory_id: int, quantity: int):
+    inventory = BookInventory.__table__
+    db.execute(
+        update(inventory)
+        .where(inventory.c.id == inventory_id)
+        .values(available_count=inventory.c.available_count + quantity)
+    )
+
+def _inventory_for_return(db: Session, db_assignment: BookAssignment):
+    """ Inventory row a returned copy goes back to; assignments made before sharding use the book's first row """
+    if db_assignment.inventory_id is not None:
+        return db_assignment.inventory_id
+    return (
+        db.query(BookInventory.id)
+        .filter(BookInventory.book_id == db_assignment.book_id)
+        .order_by(BookInventory.id)
+        .limit(1)
+        .scalar()
+    )
+
 def assign_book(db: Session, book_id: int, assignment: BookAssignmentCreate):
-    db_book = get_book(db, book_id)
-    if not db_book or db_book.available_count < assignment.quantity:
+    if assignment.quantity < 1:
+        return None
+    # Retry a few times in case another checkout drained the picked row first
+    for _ in range(3):
+        inventory_id = _pick_inventory(db, book_id, assignment.quantity, assignment.branch)
+        if inventory_id is None:
+            _check_branch_limit(db, book_id, assignment.quantity, assignment.branch)
+            return None
+        if _take_inventory(db, inventory_id, assignment.quantity):
+            break
+        db.rollback()
+    else:
         return None
     db_assignment = BookAssignment(
         book_id=book_id,
@@ -49,23 +126,145 @@ def assign_book(db: Session, book_id: int, assignment: BookAssignmentCreate):
         assignment_type=assignment.assignment_type,
         quantity=assignment.quantity,
         due_date=datetime.now() + timedelta(days=14),
+        inventory_id=inventory_id,
     )
-    db_book.available_count -= assignment.quantity
     db.add(db_assignment)
     db.commit()
     db.refresh(db_assignment)
+    if availability_broker.active:
+        availability_broker.publish_book(db_assignment.book)
     return db_assignment
 
+def _mark_returned(db: Session, assignment_ids, returned_at: datetime):
+    """ Atomically flag assignments as returned; the rowcount tells whether any were already returned """
+    result = db.execute(
+        update(BookAssignment)
+        .where(BookAssignment.id.in_(assignment_ids), BookAssignment.returned_at.is_(None))
+        .values(returned_at=returned_at)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
 def return_book(db: Session, assignment_id: int):
     db_assignment = db.query(BookAssignment).filter(BookAssignment.id == assignment_id).first()
     if not db_assignment or db_assignment.returned_at is not None:
         return None
-    db_assignment.returned_at = datetime.now(tz=timezone.utc)
-    db_assignment.book.available_count += db_assignment.quantity
+    if _mark_returned(db, [assignment_id], datetime.now(tz=timezone.utc)) != 1:
+        db.rollback()
+        return None
+    _put_inventory(db, _inventory_for_return(db, db_assignment), db_assignment.quantity)
     db.commit()
     db.refresh(db_assignment)
+    if availability_broker.active:
+        availability_broker.publish_book(db_assignment.book)
     return db_assignment
 
+def _plan_batch(db: Session, batch: BookAssignmentBatchCreate, book_ids):
+    """ Choose an inventory row for every item against a fresh snapshot of the stock
+
+    Returns (row id per item, quantity per row), or None when there is not enough stock.
+    """
+    query = db.query(BookInventory).filter(
+        BookInventory.book_id.in_(book_ids),
+        BookInventory.available_count > 0,
+    )
+    if batch.branch:
+        query = query.filter(BookInventory.branch == batch.branch)
+    remaining = {}
+    for db_inventory in query.order_by(func.random()).populate_existing().all():
+        remaining.setdefault(db_inventory.book_id, {})[db_inventory.id] = db_inventory.available_count
+    picked = []
+    taken = {}
+    for item in batch.items:
+        rows = remaining.get(item.book_id, {})
+        inventory_id = next((i for i, count in rows.items() if count >= item.quantity), None)
+        if inventory_id is None:
+            if sum(rows.values()) >= item.quantity:
+                raise BranchLimitExceeded(item.book_id, max(rows.values()))
+            return None
+        rows[inventory_id] -= item.quantity
+        taken[inventory_id] = taken.get(inventory_id, 0) + item.quantity
+        picked.append(inventory_id)
+    return picked, taken
+
+def assign_books(db: Session, batch: BookAssignmentBatchCreate):
+    """ Assign several books to one user in a single transaction; all or nothing """
+    book_ids = {item.book_id for item in batch.items}
+    if not book_ids or any(item.quantity < 1 for item in batch.items):
+        return None
+    # Re-plan from a fresh snapshot a few times in case another checkout drained a planned row first
+    for _ in range(3):
+        plan = _plan_batch(db, batch, book_ids)
+        if plan is None:
+            return None
+        picked, taken = plan
+        # Apply in ascending id order so concurrent batches cannot deadlock
+        if all(_take_inventory(db, inventory_id, taken[inventory_id]) for inventory_id in sorted(taken)):
+            break
+        db.rollback()
+    else:
+        return None
+    due_date = datetime.now() + timedelta(days=14)
+    db_assignments = [
+        BookAssignment(
+            book_id=item.book_id,
+            user_id=batch.user_id,
+            assignment_type=batch.assignment_type,
+            quantity=item.quantity,
+            due_date=due_date,
+            inventory_id=inventory_id,
+        )
+        for item, inventory_id in zip(batch.items, picked)
+    ]
+    db.add_all(db_assignments)
+    db.flush()
+    assignment_ids = [db_assignment.id for db_assignment in db_assignments]
+    db.commit()
+    if availability_broker.active:
+        for db_book in db.query(Book).filter(Book.id.in_(book_ids)).all():
+            availability_broker.publish_book(db_book)
+    # Reload every row with one SELECT instead of a refresh per assignment
+    return (
+        db.query(BookAssignment)
+        .filter(BookAssignment.id.in_(assignment_ids))
+        .order_by(BookAssignment.id)
+        .all()
+    )
+
+def return_books(db: Session, assignment_ids: list[int]):
+    """ Return several assignments in a single transaction; all or nothing """
+    unique_ids = set(assignment_ids)
+    if not unique_ids:
+        return None
+    db_assignments = (
+        db.query(BookAssignment)
+        .filter(BookAssignment.id.in_(unique_ids))
+        .order_by(BookAssignment.id)
+        .all()
+    )
+    if len(db_assignments) != len(unique_ids) or any(a.returned_at is not None for a in db_assignments):
+        return None
+    if _mark_returned(db, unique_ids, datetime.now(tz=timezone.utc)) != len(unique_ids):
+        db.rollback()
+        return None
+    returned = {}
+    for db_assignment in db_assignments:
+        inventory_id = _inventory_for_return(db, db_assignment)
+        returned[inventory_id] = returned.get(inventory_id, 0) + db_assignment.quantity
+    for inventory_id in sorted(returned):
+        _put_inventory(db, inventory_id, returned[inventory_id])
+    db.commit()
+    book_ids = {db_assignment.book_id for db_assignment in db_assignments}
+    if availability_broker.active:
+        for db_book in db.query(Book).filter(Book.id.in_(book_ids)).all():
+            availability_broker.publish_book(db_book)
+    return (
+        db.query(BookAssignment)
+        .filter(BookAssignment.id.in_(unique_ids))
+        .order_by(BookAssignment.id)
+        .all()
+    )
+
 def create_category(db: Session, name: str):
     category = Category(name=name)
     db.add(category)
@@ -2,8 +2,8 @@ import os
 
 from dotenv import load_dotenv
 
-from fastapi import Depends, FastAPI, HTTPException, Request, status
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
 from sqlalchemy.orm import Session
@@ -22,13 +22,29 @@ from app.schemas import book as book_schemas
 from app.crud import book as book_crud
 from app.config.email import conf
 from app.utils.reminder import send_due_soon_reminders
+from app.utils.events import stream_availability
+from app.utils.rate_limit import (
+    RateLimitMiddleware,
+    basic_auth_buckets,
+    blocked_for,
+    charge_buckets,
+    create_bucket_store,
+    retry_after_header,
+)
+from app.utils import profiling
+from app.config.rate_limit import RATE_LIMIT_BACKEND, RATE_LIMIT_DATABASE_URL, RATE_LIMIT_SHARDS, RATE_LIMIT_IDLE_SECONDS
 
 load_dotenv()
 
 app = FastAPI(title="Library Management")
 
+app.add_middleware(profiling.ProfilingMiddleware)
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("SESSION_SECRET_KEY"))
 
+# Added last so it runs first and turns away bursts before bcrypt or SMTP work
+rate_limit_store = create_bucket_store(RATE_LIMIT_BACKEND, RATE_LIMIT_DATABASE_URL, RATE_LIMIT_SHARDS)
+app.add_middleware(RateLimitMiddleware, store=rate_limit_store)
+
 Base.metadata.create_all(bind=engine)
 
 # Google SSO configuration
@@ -45,9 +61,15 @@ sso = GoogleSSO(
 # HTTP Basic authentication dependency for profile
 basic_auth = HTTPBasic()
 
-def get_current_user_basic(credentials: HTTPBasicCredentials = Depends(basic_auth), db: Session = Depends(get_db)):
+def get_current_user_basic(request: Request, credentials: HTTPBasicCredentials = Depends(basic_auth), db: Session = Depends(get_db)):
+    # Refuse before bcrypt while this IP, or this username from this IP, has too many failures
+    buckets = basic_auth_buckets(credentials.username, request.client.host if request.client else "unknown")
+    wait = blocked_for(rate_limit_store, buckets)
+    if wait is not None:
+        raise HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": retry_after_header(wait)})
     user = user_crud.get_user_by_username(db, credentials.username)
     if user is None or not user_crud.pwd_context.verify(credentials.password, user.hashed_password):
+        charge_buckets(rate_limit_store, buckets)
         raise HTTPException(status_code=401, detail="Incorrect username or password")
     return user
 
@@ -168,11 +190,33 @@ def update_book(book_id: int, book: book_schemas.BookUpdate, db: Session = Depen
 @app.post("/books/{book_id}/assign", response_model=book_schemas.BookAssignmentOut, tags=["book"])
 def assign_book(book_id: int, assignment: book_schemas.BookAssignmentCreate, db: Session = Depends(get_db)):
     """ Assign a book to a user """
-    db_assignment = book_crud.assign_book(db, book_id, assignment)
+    try:
+        db_assignment = book_crud.assign_book(db, book_id, assignment)
+    except book_crud.BranchLimitExceeded as err:
+        raise HTTPException(status_code=400, detail=str(err)) from err
     if not db_assignment:
         raise HTTPException(status_code=400, detail="Not enough books available or book not found")
     return db_assignment
 
+@app.post("/books/assign", response_model=list[book_schemas.BookAssignmentOut], tags=["book"])
+def assign_books(batch: book_schemas.BookAssignmentBatchCreate, db: Session = Depends(get_db)):
+    """ Assign several books to a user in one transaction """
+    try:
+        db_assignments = book_crud.assign_books(db, batch)
+    except book_crud.BranchLimitExceeded as err:
+        raise HTTPException(status_code=400, detail=str(err)) from err
+    if not db_assignments:
+        raise HTTPException(status_code=400, detail="Not enough books available or book not found")
+    return db_assignments
+
+@app.post("/books/return", response_model=list[book_schemas.BookAssignmentOut], tags=["book"])
+def return_books(batch: book_schemas.BookReturnBatch, db: Session = Depends(get_db)):
+    """ Return several book assignments in one transaction """
+    db_assignments = book_crud.return_books(db, batch.assignment_ids)
+    if not db_assignments:
+        raise HTTPException(status_code=404, detail="Assignment not found or already returned")
+    return db_assignments
+
 @app.post("/books/assignment/{assignment_id}/return", response_model=book_schemas.BookAssignmentOut, tags=["book"])
 def return_book(assignment_id: int, db: Session = Depends(get_db)):
     """ Return a book assignment """
@@ -181,9 +225,24 @@ def return_book(assignment_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Assignment not found or already returned")
     return db_assignment
 
+@app.get("/events/availability", tags=["book"])
+async def availability_events(
+    request: Request,
+    book_id: list[int] = Query(default=[]),
+    category_id: list[int] = Query(default=[]),
+    tag_id: list[int] = Query(default=[]),
+):
+    """ Stream available_count changes as server-sent events, optionally filtered by book, category or tag """
+    return StreamingResponse(
+        stream_availability(request, book_id, category_id, tag_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 def start_scheduler():
     scheduler = BackgroundScheduler()
     scheduler.add_job(send_due_soon_reminders, "interval", days=1, args=[next(get_db())])
+    scheduler.add_job(rate_limit_store.evict_idle, "interval", minutes=5, args=[RATE_LIMIT_IDLE_SECONDS])
     scheduler.start()
 
 start_scheduler()
@@ -240,3 +299,61 @@ def create_category(name: str, db: Session = Depends(get_db)):
 @app.post("/tags/", response_model=book_schemas.TagOut, tags=["book"])
 def create_tag(name: str, db: Session = Depends(get_db)):
     return book_crud.create_tag(db, name)
+
+@app.post("/admin/profiling/requests", tags=["admin"])
+def start_request_profiling(
+    path: str,
+    method: str = "GET",
+    count: int = Query(default=10, ge=1, le=1000),
+    interval_ms: int = Query(default=5, ge=1, le=1000),
+    current_user=Depends(require_admin_basic),
+):
+    """ Sample the next `count` requests to the route with this path template, e.g. /books/{book_id} """
+    route = next(
+        (r for r in app.routes if getattr(r, "path", None) == path and method.upper() in getattr(r, "methods", ())),
+        None,
+    )
+    if route is None:
+        raise HTTPException(status_code=404, detail="Route not found")
+    profiling.request_profiler.arm(route, count, interval_ms / 1000)
+    return profiling.request_profiler.status()
+
+@app.get("/admin/profiling/requests", tags=["admin"])
+def get_request_profiling_status(current_user=Depends(require_admin_basic)):
+    """ Show how many profiled requests are still pending """
+    return profiling.request_profiler.status()
+
+@app.get("/admin/profiling/requests/stacks", response_class=PlainTextResponse, tags=["admin"])
+def get_request_profile(current_user=Depends(require_admin_basic)):
+    """ Collapsed stacks of the sampled requests, ready for flamegraph.pl or speedscope """
+    return profiling.request_profiler.collapsed()
+
+@app.delete("/admin/profiling/requests", tags=["admin"])
+def cancel_request_profiling(current_user=Depends(require_admin_basic)):
+    """ Stop waiting for more requests to profile """
+    profiling.request_profiler.disarm()
+    return profiling.request_profiler.status()
+
+@app.post("/admin/profiling/tracemalloc/start", tags=["admin"])
+def start_tracemalloc(frames: int = Query(default=10, ge=1, le=100), current_user=Depends(require_admin_basic)):
+    """ Start tracing allocations; slows every allocation down until stopped """
+    profiling.start_tracemalloc(frames)
+    return {"message": "tracemalloc started"}
+
+@app.get("/admin/profiling/tracemalloc", tags=["admin"])
+def get_tracemalloc_top(
+    layer: list[str] = Query(default=list(profiling.TRACEMALLOC_LAYERS)),
+    limit: int = Query(default=20, ge=1, le=500),
+    current_user=Depends(require_admin_basic),
+):
+    """ Memory still held by allocations made from the crud layer, largest growth since tracing started first """
+    top = profiling.tracemalloc_top(layer, limit)
+    if top is None:
+        raise HTTPException(status_code=409, detail="tracemalloc is not running")
+    return top
+
+@app.post("/admin/profiling/tracemalloc/stop", tags=["admin"])
+def stop_tracemalloc(current_user=Depends(require_admin_basic)):
+    """ Stop tracing allocations and free the trace memory """
+    profiling.stop_tracemalloc()
+    return {"message": "tracemalloc stopped"}
@@ -0,0 +1,87 @@
+"""add per-branch book inventory
+
+Revision ID: 3f1c2a9d7b6e
+Revises:
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.config.inventory import INVENTORY_BRANCHES
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c2a9d7b6e'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The app calls create_all on startup, so parts of this may already exist
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("book_inventory"):
+        op.create_table(
+            "book_inventory",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("book_id", sa.Integer(), nullable=False),
+            sa.Column("branch", sa.String(), nullable=False),
+            sa.Column("available_count", sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(["book_id"], ["books.id"]),
+            sa.PrimaryKeyConstraint("id"),
+            sa.UniqueConstraint("book_id", "branch"),
+        )
+        op.create_index(op.f("ix_book_inventory_id"), "book_inventory", ["id"], unique=False)
+        op.create_index(op.f("ix_book_inventory_book_id"), "book_inventory", ["book_id"], unique=False)
+
+    if "inventory_id" not in {c["name"] for c in inspector.get_columns("book_assignments")}:
+        with op.batch_alter_table("book_assignments") as batch_op:
+            batch_op.add_column(sa.Column("inventory_id", sa.Integer(), nullable=True))
+            batch_op.create_foreign_key(
+                "fk_book_assignments_inventory_id", "book_inventory", ["inventory_id"], ["id"]
+            )
+
+    if "available_count" in {c["name"] for c in inspector.get_columns("books")}:
+        # Move each book's stock into one inventory row, then drop the old counter
+        op.execute(
+            sa.text(
+                "INSERT INTO book_inventory (book_id, branch, available_count) "
+                "SELECT id, :branch, available_count FROM books "
+                "WHERE NOT EXISTS (SELECT 1 FROM book_inventory WHERE book_inventory.book_id = books.id)"
+            ).bindparams(branch=INVENTORY_BRANCHES[0])
+        )
+        with op.batch_alter_table("books") as batch_op:
+            batch_op.drop_column("available_count")
+
+    # Loans still out go back to the book's first inventory row when returned
+    op.execute(
+        "UPDATE book_assignments SET inventory_id = "
+        "(SELECT MIN(id) FROM book_inventory WHERE book_inventory.book_id = book_assignments.book_id) "
+        "WHERE inventory_id IS NULL AND returned_at IS NULL"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("books") as batch_op:
+        batch_op.add_column(sa.Column("available_count", sa.Integer(), nullable=False, server_default="0"))
+    op.execute(
+        "UPDATE books SET available_count = "
+        "(SELECT COALESCE(SUM(available_count), 0) FROM book_inventory WHERE book_inventory.book_id = books.id)"
+    )
+    # Tables built by create_all carry an unnamed key that goes away with the column
+    inventory_fks = [
+        fk["name"] for fk in sa.inspect(op.get_bind()).get_foreign_keys("book_assignments")
+        if fk["constrained_columns"] == ["inventory_id"] and fk["name"]
+    ]
+    with op.batch_alter_table("book_assignments") as batch_op:
+        for name in inventory_fks:
+            batch_op.drop_constraint(name, type_="foreignkey")
+        batch_op.drop_column("inventory_id")
+    op.drop_index(op.f("ix_book_inventory_book_id"), table_name="book_inventory")
+    op.drop_index(op.f("ix_book_inventory_id"), table_name="book_inventory")
+    op.drop_table("book_inventory")
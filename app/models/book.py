@@ -1,7 +1,7 @@
 import enum
 
-from sqlalchemy import Column, Integer, String, Enum, DateTime, ForeignKey, Table
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Enum, DateTime, ForeignKey, Table, UniqueConstraint, func, select
+from sqlalchemy.orm import column_property, relationship
 from datetime import datetime
 
 from app.database import Base
@@ -28,6 +28,17 @@ book_tag_table = Table(
     Column("tag_id", Integer, ForeignKey("tags.id")),
 )
 
+class BookInventory(Base):
+    """ Per-branch stock of a book; checkouts only touch one of these rows """
+    __tablename__ = "book_inventory"
+    __table_args__ = (UniqueConstraint("book_id", "branch"),)
+    id = Column(Integer, primary_key=True, index=True)
+    book_id = Column(Integer, ForeignKey("books.id"), nullable=False, index=True)
+    branch = Column(String, nullable=False, default="main")
+    available_count = Column(Integer, nullable=False, default=0)
+
+    book = relationship("Book", back_populates="inventory")
+
 class Book(Base):
     __tablename__ = "books"
     id = Column(Integer, primary_key=True, index=True)
@@ -37,10 +48,10 @@ class Book(Base):
     isbn = Column(String, unique=True, index=True)
     assignment_type = Column(Enum(AssignmentType), nullable=False)
     total_count = Column(Integer, nullable=False, default=1)
-    available_count = Column(Integer, nullable=False, default=1)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     assignments = relationship("BookAssignment", back_populates="book")
+    inventory = relationship("BookInventory", back_populates="book")
     category_id = Column(Integer, ForeignKey("categories.id"))
     category = relationship("Category")
     tags = relationship("Tag", secondary=book_tag_table, backref="books")
@@ -55,6 +66,16 @@ class BookAssignment(Base):
     returned_at = Column(DateTime, nullable=True)
     quantity = Column(Integer, nullable=False, default=1)
     due_date = Column(DateTime, nullable=True)
+    inventory_id = Column(Integer, ForeignKey("book_inventory.id"), nullable=True)
 
     book = relationship("Book", back_populates="assignments")
-    user = relationship("User")
\ No newline at end of file
+    user = relationship("User")
+    inventory = relationship("BookInventory")
+
+# Live availability is the sum of the per-branch inventory rows
+Book.available_count = column_property(
+    select(func.coalesce(func.sum(BookInventory.available_count), 0))
+    .where(BookInventory.book_id == Book.id)
+    .correlate_except(BookInventory)
+    .scalar_subquery()
+)
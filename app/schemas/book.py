@@ -1,6 +1,6 @@
 import enum
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 
 class AssignmentType(str, enum.Enum):
@@ -49,10 +49,27 @@ class BookAssignmentBase(BaseModel):
     quantity: int
 
 class BookAssignmentCreate(BookAssignmentBase):
-    pass
+    branch: str | None = None
+
+# A circulation desk checks out 5-15 items at once; the cap keeps the IN (...) lists bounded
+MAX_BATCH_SIZE = 25
+
+class BookAssignmentBatchItem(BaseModel):
+    book_id: int
+    quantity: int = 1
+
+class BookAssignmentBatchCreate(BaseModel):
+    user_id: int
+    assignment_type: AssignmentType
+    branch: str | None = None
+    items: list[BookAssignmentBatchItem] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+class BookReturnBatch(BaseModel):
+    assignment_ids: list[int] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
 
 class BookAssignmentOut(BookAssignmentBase):
     id: int
+    book_id: int
     assigned_at: datetime
     returned_at: datetime | None
 
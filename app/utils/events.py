@@ -0,0 +1,94 @@
+import asyncio
+import json
+import threading
+
+# Events buffered per subscriber before the oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+class Subscription:
+    """ A single listener interested in availability changes of some books """
+
+    def __init__(self, book_ids=None, category_ids=None, tag_ids=None):
+        self.book_ids = set(book_ids or [])
+        self.category_ids = set(category_ids or [])
+        self.tag_ids = set(tag_ids or [])
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def matches(self, event: dict):
+        if not (self.book_ids or self.category_ids or self.tag_ids):
+            return True
+        return (
+            event["book_id"] in self.book_ids
+            or event["category_id"] in self.category_ids
+            or not self.tag_ids.isdisjoint(event["tag_ids"])
+        )
+
+    def put(self, event: dict):
+        """ Queue an event, dropping the oldest one if the consumer is too slow """
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+class AvailabilityBroker:
+    """ In-process fan-out of book availability changes to SSE subscribers """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self, book_ids=None, category_ids=None, tag_ids=None):
+        subscription = Subscription(book_ids, category_ids, tag_ids)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def active(self):
+        """ Whether anyone is listening; check it before loading a book just to publish it """
+        return bool(self._subscribers)
+
+    def publish_book(self, book):
+        """ Broadcast the current availability of a book; a no-op without subscribers """
+        if not self._subscribers:
+            return
+        event = {
+            "book_id": book.id,
+            "available_count": book.available_count,
+            "total_count": book.total_count,
+            "category_id": book.category_id,
+            "tag_ids": [tag.id for tag in book.tags],
+        }
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if not subscription.matches(event):
+                continue
+            try:
+                # crud functions run in the threadpool, so hand off to the subscriber's loop
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                self.unsubscribe(subscription)
+
+availability_broker = AvailabilityBroker()
+
+async def stream_availability(request, book_ids=None, category_ids=None, tag_ids=None, keepalive: float = 15.0):
+    """ Subscribe and yield server-sent events until the client disconnects """
+    subscription = None
+    try:
+        # Subscribing here pairs it with the unsubscribe below even if the stream never starts
+        subscription = availability_broker.subscribe(book_ids, category_ids, tag_ids)
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: availability\ndata: {json.dumps(event)}\n\n"
+    finally:
+        if subscription is not None:
+            availability_broker.unsubscribe(subscription)
@@ -0,0 +1,171 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from starlette.routing import Match
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RequestProfiler:
+    """ Sampling profiler for the next N requests to one route, reported as collapsed stacks
+
+    Sync routes run in the threadpool, so a per-thread profiler such as cProfile would
+    miss them. Instead every thread is sampled while a profiled request is in flight and
+    only stacks passing through the profiled route's endpoint function are kept, so
+    requests to other routes never show up. Time spent before the endpoint is called
+    (middleware, dependencies, body parsing) is not sampled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._route = None
+        self._endpoint_code = None
+        self._remaining = 0
+        self._in_flight = 0
+        self._interval = 0.005
+        self._samples = Counter()
+        self._sampler = None
+
+    @property
+    def armed(self):
+        return self._route is not None
+
+    def arm(self, route, count: int, interval: float):
+        with self._lock:
+            self._route = route
+            # Outlives the route being armed, so requests still in flight keep being sampled
+            self._endpoint_code = route.endpoint.__code__
+            self._remaining = count
+            self._interval = interval
+            self._samples = Counter()
+
+    def disarm(self):
+        with self._lock:
+            self._route = None
+            self._remaining = 0
+
+    def status(self):
+        with self._lock:
+            return {
+                "route": self._route.path if self._route else None,
+                "remaining": self._remaining,
+                "in_flight": self._in_flight,
+                "samples": sum(self._samples.values()),
+            }
+
+    def collapsed(self):
+        """ Stacks in the folded format read by flamegraph.pl and speedscope """
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self._samples.most_common())
+
+    def claim(self, scope):
+        """ Reserve one of the remaining profiled requests if the scope targets the armed route """
+        with self._lock:
+            route = self._route
+            if route is None or self._remaining <= 0 or route.matches(scope)[0] != Match.FULL:
+                return False
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._route = None
+            self._in_flight += 1
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+                self._sampler.start()
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                if self._in_flight == 0:
+                    self._sampler = None
+                    return
+                interval = self._interval
+                endpoint_code = self._endpoint_code
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                in_endpoint = False
+                while frame is not None:
+                    code = frame.f_code
+                    in_endpoint = in_endpoint or code is endpoint_code
+                    stack.append(f"{_frame_file(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if in_endpoint:
+                    stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self._samples.update(stacks)
+            time.sleep(interval)
+
+def _frame_file(filename: str):
+    """ App files by their path inside the package, so crud/book.py and schemas/book.py stay apart """
+    if filename.startswith(APP_DIR + os.sep):
+        return os.path.relpath(filename, APP_DIR)
+    return os.path.basename(filename)
+
+request_profiler = RequestProfiler()
+
+class ProfilingMiddleware:
+    """ Hands matching requests to the request profiler; a single attribute check when idle """
+
+    def __init__(self, app, profiler: RequestProfiler = request_profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if not self.profiler.armed or scope["type"] != "http" or not self.profiler.claim(scope):
+            return await self.app(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.release()
+
+# Allocation growth is reported for these layers unless asked otherwise
+TRACEMALLOC_LAYERS = ("crud",)
+
+_baseline = None
+
+def start_tracemalloc(frames: int = 10):
+    """ Start tracing and remember what is allocated now, so later reports show growth since then """
+    global _baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        _baseline = tracemalloc.take_snapshot()
+
+def stop_tracemalloc():
+    global _baseline
+    tracemalloc.stop()
+    _baseline = None
+
+def tracemalloc_top(layers=TRACEMALLOC_LAYERS, limit: int = 20):
+    """ Memory still held, and its growth since start_tracemalloc, by traceback through the given app layers
+
+    Snapshots only see live allocations: memory a request allocates and frees before the
+    snapshot, such as most serialization work, never appears here.
+    """
+    if not tracemalloc.is_tracing() or _baseline is None:
+        return None
+    layer_dirs = tuple(os.path.join(APP_DIR, layer) + os.sep for layer in layers)
+    filters = [tracemalloc.Filter(True, layer_dir + "*", all_frames=True) for layer_dir in layer_dirs]
+    snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+    # Charge each allocation to the innermost line inside the layers, not to library code below it
+    totals = {}
+    for stat in snapshot.compare_to(_baseline.filter_traces(filters), "traceback"):
+        frame = next(f for f in reversed(stat.traceback) if f.filename.startswith(layer_dirs))
+        location = f"{os.path.relpath(frame.filename, APP_DIR)}:{frame.lineno}"
+        size, size_diff, count_diff = totals.get(location, (0, 0, 0))
+        totals[location] = (size + stat.size, size_diff + stat.size_diff, count_diff + stat.count_diff)
+    top = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    return [
+        {"location": location, "size_kb": round(size / 1024, 1), "growth_kb": round(size_diff / 1024, 1), "count_growth": count_diff}
+        for location, (size, size_diff, count_diff) in top
+    ]
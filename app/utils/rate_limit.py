@@ -0,0 +1,238 @@
+import json
+import math
+import threading
+import time
+
+import anyio
+from sqlalchemy import create_engine, text
+
+# Largest request body inspected for a username or email; bigger bodies are keyed by IP only
+MAX_INSPECTED_BODY = 64 * 1024
+
+class RateLimitRule:
+    """ Token bucket limits for one route, per client IP and per submitted identity """
+
+    def __init__(self, method: str, path: str, per_ip: tuple[int, int], per_identity: tuple[int, int] | None = None, fields: tuple[str, ...] = ()):
+        self.method = method
+        self.path = path
+        # (burst capacity, period in seconds to refill it)
+        self.per_ip = per_ip
+        self.per_identity = per_identity
+        self.fields = fields
+
+RULES = [
+    RateLimitRule("POST", "/login", per_ip=(20, 60), per_identity=(5, 60), fields=("username",)),
+    RateLimitRule("POST", "/register", per_ip=(5, 60), per_identity=(3, 3600), fields=("username", "email")),
+    RateLimitRule("POST", "/password-reset/request", per_ip=(5, 60), per_identity=(3, 900), fields=("email",)),
+    RateLimitRule("POST", "/password-reset/confirm", per_ip=(10, 60), per_identity=(5, 900), fields=("email",)),
+]
+# Failed HTTP Basic logins, per client IP and per username from that IP; see basic_auth_buckets
+BASIC_AUTH_RULE = RateLimitRule("*", "basic", per_ip=(30, 60), per_identity=(10, 60))
+
+class MemoryBucketStore:
+    """ Token buckets held in memory, split over independently locked shards """
+
+    # Cheap enough to call straight from the event loop
+    blocking = False
+
+    def __init__(self, shards: int = 16):
+        self._shards = [({}, threading.Lock()) for _ in range(max(1, shards))]
+
+    def take(self, key: str, capacity: int, period: float):
+        """ Take one token; returns (allowed, seconds until a token is available) """
+        rate = capacity / period
+        now = time.monotonic()
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            tokens, updated_at = buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            if tokens < 1:
+                buckets[key] = (tokens, now)
+                return False, (1 - tokens) / rate
+            buckets[key] = (tokens - 1, now)
+            return True, 0.0
+
+    def peek(self, key: str, capacity: int, period: float):
+        """ Like take, without spending the token """
+        rate = capacity / period
+        now = time.monotonic()
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            tokens, updated_at = buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        if tokens < 1:
+            return False, (1 - tokens) / rate
+        return True, 0.0
+
+    def evict_idle(self, max_idle: float):
+        cutoff = time.monotonic() - max_idle
+        for buckets, lock in self._shards:
+            with lock:
+                for key in [k for k, (_, updated_at) in buckets.items() if updated_at < cutoff]:
+                    del buckets[key]
+
+class SQLiteBucketStore:
+    """ Token buckets in a SQLite table so every worker process shares the same limits """
+
+    # Writes can wait on the database lock, so the middleware runs them in a worker thread
+    blocking = True
+
+    def __init__(self, database_url: str):
+        self._engine = create_engine(database_url, connect_args={"check_same_thread": False, "timeout": 5})
+        with self._engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            ))
+
+    def take(self, key: str, capacity: int, period: float):
+        rate = capacity / period
+        # A single upsert refills and spends the token atomically; no row changes when the bucket is empty
+        with self._engine.begin() as conn:
+            result = conn.execute(text(
+                "INSERT INTO rate_limit_buckets (key, tokens, updated_at) VALUES (:key, :capacity - 1, :now) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "tokens = min(:capacity, tokens + (:now - updated_at) * :rate) - 1, updated_at = :now "
+                "WHERE min(:capacity, tokens + (:now - updated_at) * :rate) >= 1"
+            ), {"key": key, "capacity": capacity, "rate": rate, "now": time.time()})
+        if result.rowcount == 1:
+            return True, 0.0
+        return False, 1 / rate
+
+    def peek(self, key: str, capacity: int, period: float):
+        rate = capacity / period
+        with self._engine.connect() as conn:
+            tokens = conn.execute(text(
+                "SELECT min(:capacity, tokens + (:now - updated_at) * :rate) FROM rate_limit_buckets WHERE key = :key"
+            ), {"key": key, "capacity": capacity, "rate": rate, "now": time.time()}).scalar()
+        if tokens is None or tokens >= 1:
+            return True, 0.0
+        return False, (1 - tokens) / rate
+
+    def evict_idle(self, max_idle: float):
+        with self._engine.begin() as conn:
+            conn.execute(text("DELETE FROM rate_limit_buckets WHERE updated_at < :cutoff"), {"cutoff": time.time() - max_idle})
+
+def basic_auth_buckets(username: str, client_ip: str, rule: RateLimitRule = BASIC_AUTH_RULE):
+    """ Buckets charged by a failed HTTP Basic login
+
+    Only failures are counted and the username bucket is per IP, so wrong credentials
+    sent from elsewhere cannot lock the real user out.
+    """
+    return [
+        (f"basic:ip:{client_ip}", rule.per_ip),
+        (f"basic:username:{username.strip().lower()}:ip:{client_ip}", rule.per_identity),
+    ]
+
+def blocked_for(store, buckets):
+    """ Seconds until none of the buckets is empty any more, or None if none is empty now """
+    waits = []
+    for key, (capacity, period) in buckets:
+        allowed, wait = store.peek(key, capacity, period)
+        if not allowed:
+            waits.append(wait)
+    return max(waits) if waits else None
+
+def charge_buckets(store, buckets):
+    for key, (capacity, period) in buckets:
+        store.take(key, capacity, period)
+
+def retry_after_header(seconds: float):
+    return str(max(1, math.ceil(seconds)))
+
+def _body_identities(body: bytes | None, fields: tuple[str, ...]):
+    if not body:
+        return []
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return []
+    if not isinstance(data, dict):
+        return []
+    return [f"{field}:{str(data[field]).strip().lower()}" for field in fields if data.get(field)]
+
+class RateLimitMiddleware:
+    """ Reject login, registration and password reset bursts before any hashing or email work
+
+    HTTP Basic logins are limited where the credentials are checked, see basic_auth_buckets.
+    """
+
+    def __init__(self, app, store, rules: list[RateLimitRule] = RULES):
+        self.app = app
+        self.store = store
+        self.rules = {(rule.method, rule.path): rule for rule in rules}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        rule = self.rules.get((scope["method"], scope["path"]))
+        if rule is None:
+            return await self.app(scope, receive, send)
+
+        # Per-IP bucket first, so a flood is turned away without reading its bodies
+        client_ip = scope["client"][0] if scope.get("client") else "unknown"
+        if not await self._take_all(send, [(f"{rule.path}:ip:{client_ip}", rule.per_ip)]):
+            return
+
+        if rule.fields:
+            body, receive = await self._buffer_body(receive)
+            checks = [(f"{rule.path}:{identity}", rule.per_identity) for identity in _body_identities(body, rule.fields)]
+            if not await self._take_all(send, checks):
+                return
+        await self.app(scope, receive, send)
+
+    async def _take_all(self, send, checks):
+        """ Take a token from each bucket; send a 429 and return False at the first empty one """
+        for key, (capacity, period) in checks:
+            if self.store.blocking:
+                allowed, retry_after = await anyio.to_thread.run_sync(self.store.take, key, capacity, period)
+            else:
+                allowed, retry_after = self.store.take(key, capacity, period)
+            if not allowed:
+                await self._reject(send, retry_after)
+                return False
+        return True
+
+    async def _buffer_body(self, receive):
+        """ Read up to MAX_INSPECTED_BODY of the request body and return a receive callable that replays it
+
+        The body is None when it is larger than that; the rest is then streamed to the app unread.
+        """
+        messages = []
+        size = 0
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request" or not message.get("more_body", False):
+                break
+            size += len(message.get("body", b""))
+            if size > MAX_INSPECTED_BODY:
+                break
+        body = b"".join(m.get("body", b"") for m in messages if m["type"] == "http.request")
+        if len(body) > MAX_INSPECTED_BODY:
+            body = None
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        return body, replay
+
+    async def _reject(self, send, retry_after: float):
+        payload = json.dumps({"detail": "Too many requests"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(payload)).encode()),
+                (b"retry-after", retry_after_header(retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+def create_bucket_store(backend: str, database_url: str, shards: int):
+    if backend == "sqlite":
+        return SQLiteBucketStore(database_url)
+    return MemoryBucketStore(shards)